@@ -7,23 +7,190 @@ The approximate match doesn't care about the word order or incompleteness. See
 function docstring for more information.
 """
 
+import concurrent.futures
+import functools
+import importlib.util
+import itertools
+import os
 import re
 
+try:
+    from rapidfuzz.distance import Levenshtein as _Lev
+except ImportError:
+    _Lev = None
+
+try:
+    from rapidfuzz.process import cdist as _cdist
+except ImportError:
+    _cdist = None
+
+# rapidfuzz.process.cdist returns a numpy array
+if importlib.util.find_spec("numpy") is None:
+    _cdist = None
+
+# Minimal size of a distance matrix worth spreading over several processes
+PARALLEL_MIN_CELLS = 50000
+
+# Minimal size of a distance matrix worth spreading over several rapidfuzz
+# threads
+CDIST_PARALLEL_MIN_CELLS = 1000
+
+
+
+def _levenshtein_bitparallel(s1, s2):
+    """Levenshtein distance between two strings computed from their longest
+    common subsequence.
+
+    Since a substitution costs as much as an insertion plus a deletion, the
+    distance is len(s1) + len(s2) - 2 * LCS. The LCS is computed with the
+    bit-parallel algorithm of Hyyrö: the bits of an integer represent the
+    characters of s1 and a whole column is updated with a few bit operations
+    per character of s2.
+    """
+
+    # Bitmask of the positions of every character in s1
+    peq = {}
+    for i, c in enumerate(s1):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << len(s1)) - 1
+    v = mask
+    for c in s2:
+        u = v & peq.get(c, 0)
+        v = ((v + u) | (v - u)) & mask
+
+    lcs = len(s1) - bin(v).count("1")
+    return len(s1) + len(s2) - 2 * lcs
+
 
 
 def levenshtein(s1, s2):
-    """Levenshtein distance between two strings."""
+    """Levenshtein distance between two strings.
+
+    Insertions and deletions cost 1, substitutions cost 2.
+
+    The rapidfuzz implementation is used if available. The results are
+    memoized.
+    """
+
+    if s1 == s2:
+        return 0
+
+    # The distance is symmetric, order the strings to share the cache entries
+    if s1 > s2:
+        s1, s2 = s2, s1
+    return _levenshtein(s1, s2)
+
+
+
+@functools.lru_cache(maxsize=100000)
+def _levenshtein(s1, s2):
+    """Memoized implementation of levenshtein."""
+
+    if _Lev is not None:
+        return _Lev.distance(s1, s2, weights=(1, 1, 2))
 
-    prevrow = list(range(len(s2) + 1))
+    s1, s2 = _strip_common_affixes(s1, s2)
+
+    if not s1 or not s2:
+        return len(s1) + len(s2)
+    if len(s1) <= 64:
+        return _levenshtein_bitparallel(s1, s2)
+    return _levenshtein_dp(s1, s2)
+
+
+
+def _strip_common_affixes(s1, s2):
+    """Remove the common prefix and suffix of two strings. They don't change
+    the levenshtein distance."""
+
+    prefix = 0
+    for c1, c2 in zip(s1, s2):
+        if c1 != c2:
+            break
+        prefix += 1
+
+    suffix = 0
+    for c1, c2 in zip(reversed(s1[prefix:]), reversed(s2[prefix:])):
+        if c1 != c2:
+            break
+        suffix += 1
+
+    return s1[prefix:len(s1) - suffix], s2[prefix:len(s2) - suffix]
+
+
+
+def _levenshtein_dp(s1, s2):
+    """Levenshtein distance computed with a dynamic programming matrix."""
+
+    # A single row is updated in place. The upper-left (diag) and left cells
+    # are kept in local variables.
+    row = list(range(len(s2) + 1))
 
     for i1, c1 in enumerate(s1, 1):
-        row = [i1]
+        diag = row[0]
+        left = row[0] = i1
         for i2, c2 in enumerate(s2, 1):
             matchscore = 0 if c1 == c2 else 2
-            row.append(min(row[-1] + 1, prevrow[i2] + 1, prevrow[i2 - 1] + matchscore))
-        prevrow = row
+            up = row[i2]
+            left = row[i2] = min(left + 1, up + 1, diag + matchscore)
+            diag = up
+
+    return row[-1]
+
+
+
+@functools.lru_cache(maxsize=4096)
+def _words(s):
+    """Split a string into a tuple of lowercase words."""
+
+    return tuple(re.sub(r'\W+', " ", s.lower()).split())
+
+
+
+def _distance_matrix(l1, l2, workers=1):
+    """Matrix of the levenshtein distances between the words of l1 and l2.
+
+    The matrix is a list of rows, one per word of l1. If available,
+    rapidfuzz.process.cdist is used to compute the whole matrix at once with
+    the given number of workers (-1 meaning all the CPUs).
+
+    Otherwise, large matrices are split by columns and computed by a pool of
+    processes.
 
-    return prevrow[-1]
+    Matrices smaller than CDIST_PARALLEL_MIN_CELLS with rapidfuzz, or
+    PARALLEL_MIN_CELLS without, are always computed by a single worker since
+    starting the others would cost more than it saves.
+    """
+
+    cells = len(l1) * len(l2)
+
+    if _cdist is not None:
+        if cells < CDIST_PARALLEL_MIN_CELLS:
+            workers = 1
+        return _cdist(l1, l2, scorer=_Lev.distance, scorer_kwargs={"weights": (1, 1, 2)},
+                      workers=workers).tolist()
+
+    if workers == 1 or cells < PARALLEL_MIN_CELLS:
+        return _distance_submatrix(l1, l2)
+
+    if workers == -1:
+        workers = os.cpu_count() or 1
+
+    l2 = list(l2)
+    chunksize = -(-len(l2) // workers)
+    chunks = [l2[i:i + chunksize] for i in range(0, len(l2), chunksize)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        parts = list(executor.map(_distance_submatrix, itertools.repeat(l1), chunks))
+
+    return [[d for part in parts for d in part[i]] for i in range(len(l1))]
+
+
+
+def _distance_submatrix(l1, l2):
+    """Compute the distance matrix with levenshtein. Used by _distance_matrix."""
+
+    return [[levenshtein(w1, w2) for w2 in l2] for w1 in l1]
 
 
 
@@ -33,8 +200,8 @@ def _greedy_multimatch(s1, s2):
     s2 can be matched with several words of s1.
     The final score is the sum of all the matched edit distances."""
 
-    l1 = re.sub(r'\W+', " ", s1.lower()).split()
-    l2 = re.sub(r'\W+', " ", s2.lower()).split()
+    l1 = _words(s1)
+    l2 = _words(s2)
     return sum(min(levenshtein(w1, w2) for w2 in l2) for w1 in l1)
 
 
@@ -46,11 +213,18 @@ def _greedy_multimatch2(s1, s2):
     is repeated as long as there are words in either bag.
     The final score is the sum of all the matched edit distances."""
 
-    l1 = re.sub(r'\W+', " ", s1.lower()).split()
-    l2 = re.sub(r'\W+', " ", s2.lower()).split()
+    l1 = _words(s1)
+    l2 = _words(s2)
+    return _greedy_matrixmatch(_distance_matrix(l1, l2), len(l1), len(l2))
+
+
+
+def _greedy_matrixmatch(matrix, n1, n2):
+    """Greedy matching of _greedy_multimatch2 performed on the distance matrix
+    between a bag of n1 words and a bag of n2 words."""
 
     # Distance matrix is represented as a list of tuple (distance, y, x)
-    dists = [(levenshtein(w1, w2), i, j) for i, w1 in enumerate(l1) for j, w2 in enumerate(l2)]
+    dists = [(d, i, j) for i, row in enumerate(matrix) for j, d in enumerate(row)]
     dists.sort()
 
     # Words are "removed" from the bags by ignoring their rows and columns in
@@ -67,11 +241,11 @@ def _greedy_multimatch2(s1, s2):
         done1.add(i)
         done2.add(j)
 
-    return total + abs(len(l1) - len(l2))
-    return total, abs(len(l1) - len(l2))
+    return total + abs(n1 - n2)
 
 
 
+@functools.lru_cache(maxsize=4096)
 def approx_score(s1, s2):
     """Score of "likeness" of two strings.
 
@@ -80,16 +254,88 @@ def approx_score(s1, s2):
     For each word of the first string, it finds the best match among the words
     of the second string.
     The final score is the sum of all the best-match scores.
+
+    The results are memoized.
     """
     return _greedy_multimatch2(s1, s2)
 
 
 
 
+def _haystack_matrix(nail_words, hays_words):
+    """Distance matrix between the words of the nail and every distinct word of
+    the haystack, computed all at once.
+
+    Return the matrix and a dict mapping each word of the haystack to its
+    column.
+    """
+
+    columns = {}
+    for words in hays_words:
+        for w in words:
+            columns.setdefault(w, len(columns))
+
+    matrix = _distance_matrix(nail_words, list(columns), workers=-1)
+    return matrix, columns
+
+
+
+def _hay_score(matrix, columns, nail_words, words):
+    """approx_score of a hay computed from the matrix of _haystack_matrix."""
+
+    cols = [columns[w] for w in words]
+    submatrix = [[row[j] for j in cols] for row in matrix]
+    return _greedy_matrixmatch(submatrix, len(nail_words), len(words))
+
+
+
+def approx_scores(nail, haystack, key=None):
+    """Score of "likeness" of the nail with every string of the haystack, as
+    returned by approx_score.
+
+    The words of the whole haystack are scored against the words of the nail
+    all at once.
+    """
+
+    if key is None:
+        key = lambda x: x
+
+    nail_words = _words(nail)
+    hays_words = [_words(key(hay)) for hay in haystack]
+    matrix, columns = _haystack_matrix(nail_words, hays_words)
+    return [_hay_score(matrix, columns, nail_words, words) for words in hays_words]
+
+
+
 def approx_match(nail, haystack, key=None):
     """This function looks for a nail (not quite a needle) in a haystack. It
-    returns the matching needle."""
+    returns the matching needle.
+
+    The words of the whole haystack are scored against the words of the nail
+    all at once. Each hay is then scored as with approx_score.
+    """
 
     if key is None:
         key = lambda x: x
-    return min(haystack, key=lambda hay: approx_score(nail, key(hay)))
+
+    haystack = list(haystack)
+    nail_words = _words(nail)
+    hays_words = [_words(key(hay)) for hay in haystack]
+    matrix, columns = _haystack_matrix(nail_words, hays_words)
+
+    best = None
+    bestscore = None
+    for hay, words in zip(haystack, hays_words):
+        # Every unmatched word adds 1 to the score
+        if bestscore is not None and abs(len(nail_words) - len(words)) >= bestscore:
+            continue
+
+        score = _hay_score(matrix, columns, nail_words, words)
+        if bestscore is None or score < bestscore:
+            best = hay
+            bestscore = score
+
+    if bestscore is None:
+        raise ValueError("Empty haystack")
+
+    return best
@@ -4,22 +4,30 @@ import argparse
 import collections
 import datetime
 import decimal
+import io
 import locale
 import logging
 import logging.config
+import operator
 import os
-import subprocess
-import shutil
 import sys
 
 import icalendar
 
 import approxmatch
+import textdiff
 import workfile
 
 
 
 SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+SECONDS_PER_HOUR = decimal.Decimal(3600)
+
+
+
+# The fields of a VEVENT, read once from the icalendar component.
+# course is the tuple (SUMMARY, DESCRIPTION).
+Event = collections.namedtuple("Event", ["start", "end", "course", "vevent"])
 
 
 
@@ -33,16 +41,26 @@ def logging_getHandler(name):
 
 
 
-def dedup(objs, eqfunc=None, hashfunc=None):
+def dedup(objs, eqfunc=None, keyfunc=None):
     """Remove duplicate objects as with list(set(objs)) but with custom
-    equality and / or hash functions.
+    equality and / or key functions.
 
     If given, the comparison is based on the equality function. If not, native
     == operator is used.
-    If given, the hash function is used to make the objects hashable. If not
-    given, the builtin hash function is used on the objects.
+    If given, the key function maps the objects to hashable values that are
+    used in their stead. If not given, the objects themselves are used.
+
+    Without an equality function, objects with equal keys are considered equal
+    and the first one is kept.
     """
 
+    if eqfunc is None:
+        seen = {}
+        for obj in objs:
+            key = obj if keyfunc is None else keyfunc(obj)
+            seen.setdefault(key, obj)
+        return list(seen.values())
+
     class Wrapper:
         """Wrapper to allow to hash and test equality of any object."""
 
@@ -50,13 +68,11 @@ def dedup(objs, eqfunc=None, hashfunc=None):
             self.obj = obj
 
         def __eq__(self, other):
-            if eqfunc is not None:
-                return eqfunc(self.obj, other.obj)
-            return self.obj == other.obj
+            return eqfunc(self.obj, other.obj)
 
         def __hash__(self):
-            if hashfunc is not None:
-                return hashfunc(self.obj)
+            if keyfunc is not None:
+                return hash(keyfunc(self.obj))
             return hash(self.obj)
 
     return [w.obj for w in set(Wrapper(obj) for obj in objs)]
@@ -76,39 +92,36 @@ def partition(it, keyfunc):
 
 
 
-def sorted_dict(d, sortkey=None):
-    """Return an OrderedDict with keys sorted.
-
-    If sortkey is given, use it as argument to the function 'sorted'."""
-
-    retval = collections.OrderedDict()
-    for k in sorted(d, key=sortkey):
-        retval[k] = d[k]
-    return retval
-
-
-
 def sum_events_duration(events):
-    """Sum the events duration from a structure returned by icalendar."""
+    """Sum the duration of Event tuples."""
 
-    return sum(decimal.Decimal((e["DTEND"].dt - e["DTSTART"].dt).seconds) / 60 / 60 for e in events)
+    seconds = sum((e.end - e.start).seconds for e in events)
+    return decimal.Decimal(seconds) / SECONDS_PER_HOUR
 
 
 
 def structure_by_date(cal):
-    """Take an icalendar Calendar and return the events partitionned by SUMMARY and DESCRIPTION."""
+    """Take an icalendar Calendar and return the events partitionned by SUMMARY
+    and DESCRIPTION, then by date.
+
+    The events are returned as Event tuples.
+    """
 
     events = cal.walk("VEVENT")
-    events = dedup(events, hashfunc=lambda e: hash(e.to_ical()))
-    events.sort(key=lambda e: e["DTSTART"].dt)
+    events = dedup(events, keyfunc=lambda e: e.to_ical())
+    events = [Event(e["DTSTART"].dt, e["DTEND"].dt, (e["SUMMARY"], e["DESCRIPTION"]), e)
+              for e in events]
+    events.sort(key=operator.attrgetter("start"))
 
-    bycourse = partition(events, keyfunc=lambda e: (e["SUMMARY"], e["DESCRIPTION"]))
-    bycourse = sorted_dict(bycourse, sortkey=lambda l: bycourse[l][-1]["DTSTART"].dt)
+    bycourse = partition(events, keyfunc=operator.attrgetter("course"))
 
+    # Sort the courses by the start of their last event. Since the events are
+    # sorted, the dates of each course are inserted in order.
     bycoursedate = collections.OrderedDict()
-    for (course, students), events in bycourse.items():
-        bydate = partition(events, keyfunc=lambda e: e["DTSTART"].dt.date())
-        bycoursedate[course, students] = sorted_dict(bydate)
+    for course, events in sorted(bycourse.items(), key=lambda item: item[1][-1].start):
+        bydate = bycoursedate[course] = collections.OrderedDict()
+        for ev in events:
+            bydate.setdefault(ev.start.date(), []).append(ev)
 
     return bycoursedate
 
@@ -136,15 +149,18 @@ def ics_to_workfile(ics, rate):
         for date, evs in bydate.items():
             total_duration = sum_events_duration(evs).normalize()
             entry = workfile.EntryFull(date, total_duration, rate)
-            sec.entries.append(entry)
+            sec.append(entry)
         wf.sections.append(sec)
 
     return wf
 
 
 
-def partial_entry_matches(entry, entries):
-    """Finds partial matches between one workfile entry and a list of entries.
+def partial_entry_matches(entry, entries, entries_by_date):
+    """Finds partial matches between one workfile entry and a Counter of entries.
+
+    entries_by_date is the partition of the keys of entries by date. It only
+    has to be computed once since the counts are read from entries.
 
     It returns 3 lists of entries:
         - The list of entries that match only the date.
@@ -152,47 +168,60 @@ def partial_entry_matches(entry, entries):
         - The list of entries that match the date and rate.
     """
 
+    hours, rate = entry.hours, entry.rate
+
     datematch = []
     datehoursmatch = []
     dateratematch = []
-    for removed_entry in entries.elements():
-        if removed_entry.date == entry.date:
-            if removed_entry.hours != entry.hours and removed_entry.rate != entry.rate:
-                datematch.append(removed_entry)
-            if removed_entry.hours == entry.hours:
-                datehoursmatch.append(removed_entry)
-            if removed_entry.rate == entry.rate:
-                dateratematch.append(removed_entry)
+    for removed_entry in entries_by_date.get(entry.date, ()):
+        cnt = entries[removed_entry]
+        if cnt <= 0:
+            continue
+
+        # Compare once and add as many copies as the Counter holds
+        copies = [removed_entry] * cnt
+        samehours = removed_entry.hours == hours
+        samerate = removed_entry.rate == rate
+        if not samehours and not samerate:
+            datematch.extend(copies)
+        if samehours:
+            datehoursmatch.extend(copies)
+        if samerate:
+            dateratematch.extend(copies)
 
     return datematch, datehoursmatch, dateratematch
 
 
 
 def _update_section_approx_title_match(wf, title, start, end):
-    wff = wf.filter(start, end, title)
+    """Return the list of sections of wf within the date interval having the
+    given title, or the closest title if none match exactly."""
+
+    # Filter by date once, the titles are then compared on the result
+    sections = wf.filter(start, end).sections
+    wff = [s for s in sections if s.title == title]
     if len(wff) != 0:
         return wff
 
     logging.info("No section found for: %s", title)
     logging.info("Doing an approximate search")
 
-    wff_notitle = wf.filter(start, end)
-    titles = [s.title for s in wff_notitle]
+    titles = [s.title for s in sections]
     actual_title = approxmatch.approx_match(title, titles)
 
     if approxmatch.approx_score(title, actual_title) / len(actual_title) < 0.1:
         logging.info("Matched with: %s", actual_title)
-        wff = wf.filter(start, end, actual_title)
+        wff = [s for s in sections if s.title == actual_title]
 
     return wff
 
 
 
-def _update_section_ignore_sum_match(added_entries, removed_entries):
+def _update_section_ignore_sum_match(added_entries, removed_entries, removed_by_date):
     """If an entry already match a sum of existing entries, match them."""
 
     for added_entry in added_entries.elements():
-        _, _, dateratematch = partial_entry_matches(added_entry, removed_entries)
+        _, _, dateratematch = partial_entry_matches(added_entry, removed_entries, removed_by_date)
         dateratematch_hours = sum(e.hours for e in dateratematch)
 
         if dateratematch_hours == added_entry.hours and len(dateratematch) > 1:
@@ -206,12 +235,12 @@ def _update_section_ignore_sum_match(added_entries, removed_entries):
 
 
 
-def _update_section_fix_partial(added_entries, removed_entries, wfsec):
+def _update_section_fix_partial(added_entries, removed_entries, removed_by_date, wfsec):
     """If there are entries matching the date and rate, fix the entry if there's
     only one or add a new one if there are already several."""
 
     for added_entry in added_entries.elements():
-        _, _, dateratematch = partial_entry_matches(added_entry, removed_entries)
+        _, _, dateratematch = partial_entry_matches(added_entry, removed_entries, removed_by_date)
         dateratematch_hours = sum(e.hours for e in dateratematch)
 
         if len(dateratematch) == 1:
@@ -237,7 +266,7 @@ def _update_section_fix_partial(added_entries, removed_entries, wfsec):
             # Apply immediately to avoid further matching.
             added_entries[added_entry] -= 1
             added_entry.hours = remhours
-            wfsec.entries.append(added_entry)
+            wfsec.append(added_entry)
 
         elif len(dateratematch) > 1 and dateratematch_hours > added_entry.hours:
             # Too many hours? Let it go to a remove and add
@@ -249,12 +278,12 @@ def _update_section_fix_partial(added_entries, removed_entries, wfsec):
 
 
 
-def _update_section_ignore_rate_nonmatch(added_entries, removed_entries):
+def _update_section_ignore_rate_nonmatch(added_entries, removed_entries, removed_by_date):
     """Louldly ignore partial matches that don't match the rate. This is common
     since the hourly rate isn't in the ics file."""
 
     for added_entry in added_entries.elements():
-        _, datehoursmatch, _ = partial_entry_matches(added_entry, removed_entries)
+        _, datehoursmatch, _ = partial_entry_matches(added_entry, removed_entries, removed_by_date)
 
         if len(datehoursmatch) > 0:
             logging.warning("Hourly rate doesn't match for: %s", added_entry)
@@ -268,11 +297,11 @@ def _update_section_ignore_rate_nonmatch(added_entries, removed_entries):
 
 
 
-def _update_section_warn_date_only_match(added_entries, removed_entries):
+def _update_section_warn_date_only_match(added_entries, removed_entries, removed_by_date):
     """Warn about date-only match, but perform them anyway."""
 
     for added_entry in added_entries.elements():
-        datematch, _, _ = partial_entry_matches(added_entry, removed_entries)
+        datematch, _, _ = partial_entry_matches(added_entry, removed_entries, removed_by_date)
 
         if len(datematch) > 0:
             logging.warning("Found matches for date but hours and rate don't match: %s",
@@ -290,11 +319,11 @@ def _update_section_apply_changes(wfsec, added_entries, removed_entries):
 
     # Add new entries
     for added_entry in added_entries.elements():
-        wfsec.entries.append(added_entry)
+        wfsec.append(added_entry)
 
     # Find and discard removed entries
     for removed_entry in removed_entries.elements():
-        wfsec.entries.remove(removed_entry)
+        wfsec.remove(removed_entry)
 
     return wfsec
 
@@ -341,10 +370,11 @@ def update_section(wf, newsec, icsstart, icsend):
         logging.debug("Ignoring a match: %s", e)
 
     # Keep filtering the added entires to remove non-exact matches
-    added, removed = _update_section_ignore_sum_match(added, removed)
-    added, removed = _update_section_fix_partial(added, removed, wfsec)
-    added, removed = _update_section_ignore_rate_nonmatch(added, removed)
-    added, removed = _update_section_warn_date_only_match(added, removed)
+    removed_by_date = partition(removed, keyfunc=lambda e: e.date)
+    added, removed = _update_section_ignore_sum_match(added, removed, removed_by_date)
+    added, removed = _update_section_fix_partial(added, removed, removed_by_date, wfsec)
+    added, removed = _update_section_ignore_rate_nonmatch(added, removed, removed_by_date)
+    added, removed = _update_section_warn_date_only_match(added, removed, removed_by_date)
 
     wfsec = _update_section_apply_changes(wfsec, added, removed)
 
@@ -394,20 +424,23 @@ def do_stuff(args):
     for sec in icswf:
         update_section(wf, sec, icsstart, icsend)
 
-    newworkfile = workfilename + ".new"
-    with open(newworkfile, "w") as fp:
-        print(wf, file=fp)
-        print("", file=fp)
+    with open(workfilename) as fp:
+        oldlines = fp.readlines()
+    newlines = io.StringIO(str(wf) + "\n\n").readlines()
 
+    newworkfile = workfilename + ".new"
     if args.show_diff:
-        exitvalue = subprocess.call(["diff", "--color", "--text", "--unified",
-                                     "--show-function-line=^#", workfilename, newworkfile])
-        if exitvalue == 0:
+        textdiff.print_diff(oldlines, newlines, workfilename, newworkfile, funcline_prefix="#")
+        if oldlines == newlines:
             logging.info("No change made to the Workfile")
             if args.write:
                 logging.info("Nothing to write")
                 args.write = False
 
+    if args.write:
+        with open(newworkfile, "w") as fp:
+            fp.writelines(newlines)
+
     if args.write and not args.force:
         res = input("Write these changes? [yN] ")
         if not res or res not in "yY":
@@ -419,8 +452,8 @@ def do_stuff(args):
         bakworkfile = workfilename + ".bak"
         logging.info("Writing changes to %s, old workfile copied to %s",
                      workfilename, bakworkfile)
-        shutil.move(workfilename, bakworkfile)
-        shutil.move(newworkfile, workfilename)
+        os.replace(workfilename, bakworkfile)
+        os.replace(newworkfile, workfilename)
 
     return 0
 
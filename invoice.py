@@ -10,6 +10,61 @@ import typing
 
 
 
+RE_INVNUM = re.compile(r'(\d+)_')
+
+# Patterns matching the LaTeX commands in the invoice
+RE_VATNO = re.compile(r'\\setvatno\{([^}]*)\}')
+RE_MORESMALLPRINTS = re.compile(r'\\setmoresmallprints\{([^}]*)\}')
+RE_INVDATE = re.compile(r'\\setinvoicedate\{([^}]*)\}')
+RE_ADDITEM = re.compile(r'\\additem\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}')
+
+# Same patterns in the template, where the braces are doubled
+RE_MORESMALLPRINTS_TPL = re.compile(r"\\setmoresmallprints\{\{[^}]*\}\}")
+RE_INVDATE_TPL = re.compile(r"\\setinvoicedate\{\{[^}]*\}\}")
+RE_ADDITEM_TPL = re.compile(r'\\additem\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}')
+
+
+
+def _parse_date(text, order, strict=True):
+    """Parse a date made of three numbers separated by slashes. Faster than
+    strptime.
+
+    The order of the fields is given as a string, "dmy" or "ymd". The year has
+    4 digits, the day and the month have 2 digits, or 1 or 2 if not strict.
+
+    Raise ValueError if the date is invalid.
+    """
+
+    values = text.split("/")
+    if len(values) != 3:
+        raise ValueError(f"Invalid date {text!r}")
+
+    fields = {}
+    for field, value in zip(order, values):
+        widths = (4,) if field == "y" else (2,) if strict else (1, 2)
+        if len(value) not in widths or not value.isdigit():
+            raise ValueError(f"Invalid date {text!r}")
+        fields[field] = int(value)
+
+    return datetime.date(fields["y"], fields["m"], fields["d"])
+
+
+
+def _parse_itemdate(text):
+    """Parse the date of an invoice item, either DD/MM/YYYY or YYYY/MM/DD.
+
+    Return None if the date is in neither format.
+    """
+
+    for order in ("dmy", "ymd"):
+        try:
+            return _parse_date(text, order)
+        except ValueError:
+            pass
+    return None
+
+
+
 class ParseError(RuntimeError):
     """Base class for parsing errors."""
 
@@ -27,7 +82,7 @@ class InvoiceTextError(InvoiceContentError):
 
 
 
-@dataclasses.dataclass(order=True, frozen=True)
+@dataclasses.dataclass(order=True, frozen=True, slots=True)
 class Item:
     """Represents an invoice item.
 
@@ -83,68 +138,63 @@ class Invoice:
 
         logging.info("Reading invoice: %s", filename)
         basename = os.path.basename(filename)
-        m = re.match(r'(\d+)_', basename)
+        m = RE_INVNUM.match(basename)
         if not m:
             logging.critical("Filename %r does not start with an invoice number", basename)
             raise InvoiceFilenameError(f"Malformed filename {filename}")
 
         invnum = m.group(1)
 
-        template = ""
-        data = ""
+        template = []
+        data = []
         with open(filename) as fp:
             for line in fp:
-                template += line
+                template.append(line)
                 commentpos = line.find("%")
                 if commentpos == -1:
                     commentpos = None
                 line = line[:commentpos]
                 if line:
-                    logging.debug("Read line: %r", line[:commentpos])
-                    data += line[:commentpos]
+                    logging.debug("Read line: %r", line)
+                    data.append(line)
 
+        template = "".join(template)
+        data = "".join(data)
         template = template.replace("{", "{{").replace("}", "}}")
         smallprints = cls.default_smallprints
         invdate = None
         items = []
 
-        m = re.search(r'\\setvatno\{([^}]*)\}', data)
+        m = RE_VATNO.search(data)
         if m:
             raise NotImplementedError("Having VAT number is not supported yet")
         smallprints += "\n" + cls.default_novatmsg
 
-        m = re.search(r'\\setmoresmallprints\{([^}]*)\}', data)
+        m = RE_MORESMALLPRINTS.search(data)
         if m:
             smallprints += "\n" + m.group(1)
-            template = re.sub(r"\\setmoresmallprints\{\{[^}]*\}\}", "{moresmallprints}", template)
+            template = RE_MORESMALLPRINTS_TPL.sub("{moresmallprints}", template)
 
-        m = re.search(r'\\setinvoicedate\{([^}]*)\}', data)
+        m = RE_INVDATE.search(data)
         if m is None:
             logging.critical("No date detected in the invoice")
             raise InvoiceDateError("No invoice date")
 
         invdate = m.group(1)
-        invdate = datetime.datetime.strptime(invdate, "%d/%m/%Y").date()
-        template = re.sub(r"\\setinvoicedate\{\{[^}]*\}\}", "{invdate}", template)
-
-        it = re.finditer(r'\\additem\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}\{([^}]*)\}', data)
-        for m in it:
-            text, time, unit, rate, vat = m.groups()
-            m = re.match(r'(.*) - (\d{2}/\d{2}/\d{4}|\d{4}/\d{2}/\d{2})$', text)
-            if m is None:
+        invdate = _parse_date(invdate, "dmy", strict=False)
+        template = RE_INVDATE_TPL.sub("{invdate}", template)
+
+        for text, time, unit, rate, vat in RE_ADDITEM.findall(data):
+            itemdesc, sep, itemdate = text.rpartition(" - ")
+            if not sep:
                 raise InvoiceTextError(f"Invoice item {text!r} has invalid format")
-            itemdesc = m.group(1)
-            itemdate = m.group(2)
-            try:
-                itemdate = datetime.datetime.strptime(itemdate, "%d/%m/%Y").date()
-            except ValueError:
-                itemdate = datetime.datetime.strptime(itemdate, "%Y/%m/%d").date()
-            time = decimal.Decimal(time)
-            rate = decimal.Decimal(rate)
-            vat = decimal.Decimal(vat)
-            items.append(Item(itemdesc, itemdate, time, unit, rate, vat))
-
-        matches = re.finditer(r'\\additem\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}\{\{([^}]*)\}\}', template)
+            itemdate = _parse_itemdate(itemdate)
+            if itemdate is None:
+                raise InvoiceTextError(f"Invoice item {text!r} has invalid format")
+            items.append(Item(itemdesc, itemdate, decimal.Decimal(time), unit,
+                              decimal.Decimal(rate), decimal.Decimal(vat)))
+
+        matches = RE_ADDITEM_TPL.finditer(template)
         matches = list(matches)
         start = matches[0].start()
         end = matches[-1].end()
@@ -154,10 +204,8 @@ class Invoice:
         return cls(invnum, invdate, items, smallprints, template)
 
     def __str__(self):
-        items = ""
-        for i in self.items:
-            date = i.date.strftime("%d/%m/%Y")
-            items += f"\\additem{{{i.desc} - {date}}}{{{i.time}}}{{{i.unit}}}{{{i.rate}}}{{{i.vat}}}\n"
+        items = "".join(f"\\additem{{{i.desc} - {i.date:%d/%m/%Y}}}{{{i.time}}}{{{i.unit}}}{{{i.rate}}}{{{i.vat}}}\n"
+                        for i in self.items)
 
         items = items.strip()
         invdate = f"\\setinvoicedate{{{self.invdate.strftime('%d/%m/%Y')}}}"
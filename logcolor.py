@@ -9,6 +9,11 @@ import colorama
 
 
 
+# colorama.init wraps sys.stdout and sys.stderr, it only needs to be done once
+_colorama_initialized = False
+
+
+
 class ColorLogFormatter(logging.Formatter):
     """Log formatter that adds color to the debug level word."""
 
@@ -21,8 +26,14 @@ class ColorLogFormatter(logging.Formatter):
     }
 
     def __init__(self, *args, **kwargs):
+        global _colorama_initialized
+
         super().__init__(*args, **kwargs)
-        colorama.init()
+        if not _colorama_initialized:
+            colorama.init()
+            _colorama_initialized = True
+
+        self._colornames = {name: self._colorname(name) for name in self.namecolors}
 
     def _colorname(self, name):
         s = self.namecolors.get(name, "")
@@ -37,5 +48,10 @@ class ColorLogFormatter(logging.Formatter):
         logconf.ini.
         """
 
-        record.levelnamecolor = self._colorname(record.levelname)
+        name = record.levelname
+        colorname = self._colornames.get(name)
+        if colorname is None:
+            colorname = self._colornames[name] = self._colorname(name)
+
+        record.levelnamecolor = colorname
         return super().format(record)
@@ -0,0 +1,48 @@
+"""Print unified diffs of text files.
+
+The diffs look like the ones of GNU diff --unified --color.
+"""
+
+import difflib
+import re
+import sys
+
+
+
+RE_HUNK = re.compile(r'@@ -(\d+)')
+
+# ANSI colors used by GNU diff --color
+DIFF_COLORS = {"---": "\033[1m", "+++": "\033[1m", "@@": "\033[36m", "-": "\033[31m", "+": "\033[32m"}
+DIFF_RESET = "\033[m"
+
+
+
+def print_diff(oldlines, newlines, oldname, newname, funcline_prefix=None, fp=None):
+    """Print a unified diff of two lists of lines, colored if fp is a tty.
+
+    If funcline_prefix is given, as with diff --show-function-line, the hunk
+    headers are followed by the last line starting with it before the hunk.
+    """
+
+    if fp is None:
+        fp = sys.stdout
+
+    colored = fp.isatty()
+    for line in difflib.unified_diff(oldlines, newlines, oldname, newname):
+        m = RE_HUNK.match(line)
+        if m and funcline_prefix is not None:
+            start = int(m.group(1)) - 1
+            for funcline in reversed(oldlines[:start]):
+                if funcline.startswith(funcline_prefix):
+                    line = line.rstrip("\n") + " " + funcline
+                    break
+
+        if not line.endswith("\n"):
+            line += "\n\\ No newline at end of file\n"
+
+        if colored:
+            color = next((c for prefix, c in DIFF_COLORS.items() if line.startswith(prefix)), None)
+            if color is not None:
+                line = color + line.rstrip("\n") + DIFF_RESET + "\n"
+
+        fp.write(line)
@@ -1,10 +1,12 @@
 """Set of classes and functions to represent and manipulate a workfile."""
 
+import bisect
 import dataclasses
 import datetime
 import decimal
-
-import more_itertools
+import functools
+import itertools
+import operator
 
 
 
@@ -14,13 +16,13 @@ class UnsortableError(ValueError):
 
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Entry:
     """Base class for the workfile entries."""
 
 
 
-@dataclasses.dataclass(order=True, unsafe_hash=True)
+@dataclasses.dataclass(order=True, unsafe_hash=True, slots=True)
 class EntryFull(Entry):
     """Full entry of a workfile.
 
@@ -39,15 +41,13 @@ class EntryFull(Entry):
     prespaces: int = dataclasses.field(default=1, compare=False)
 
     def __str__(self):
-        s = f"{self.date} {self.hours} {self.rate}"
-        if self.comment is not None:
-            s += " " * self.prespaces
-            s += f"#{self.comment}"
-        return s
+        if self.comment is None:
+            return f"{self.date} {self.hours} {self.rate}"
+        return f"{self.date} {self.hours} {self.rate}{' ' * self.prespaces}#{self.comment}"
 
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class EntryComment(Entry):
     """An workfile entry consisting of a single comment and nothing else."""
 
@@ -65,6 +65,10 @@ class Section:
     A section is a set of lines in the workfile separated by blank lines.
     If the first few lines of a section are comments, they are considered the
     title of the section. The titles can be used to identify the sections.
+
+    Some values computed from the entries are cached. Entries should be added
+    and removed with the methods append and remove. If the list of entries is
+    modified directly, invalidate must be called.
     """
 
     entries: list
@@ -76,7 +80,7 @@ class Section:
 
         return len(self.entries)
 
-    @property
+    @functools.cached_property
     def title_comment(self):
         """Return a EntryComment representing the section title.
 
@@ -95,7 +99,7 @@ class Section:
 
         return EntryComment("\n".join(c.comment for c in self.entries[:n]))
 
-    @property
+    @functools.cached_property
     def title(self):
         """Return the section title as a string."""
 
@@ -107,37 +111,107 @@ class Section:
             c = c[1:]
         return c
 
-    @property
+    @functools.cached_property
     def full_entries(self):
-        """A view of self.entries where only the full entries are returned."""
+        """The list of the full entries of self.entries, in the same order.
+
+        It should not be modified.
+        """
+
+        return [e for e in self.entries if isinstance(e, EntryFull)]
+
+    @functools.cached_property
+    def _sorted_dates(self):
+        """Dates of the full entries if they are in chronological order, None
+        otherwise."""
+
+        dates = [e.date for e in self.full_entries]
+        if all(d1 <= d2 for d1, d2 in itertools.pairwise(dates)):
+            return dates
+        return None
 
-        return (e for e in self.entries if isinstance(e, EntryFull))
+    @functools.cached_property
+    def _date_bounds(self):
+        dates = [e.date for e in self.full_entries]
+        return min(dates, default=None), max(dates, default=None)
 
     def first_date(self):
         """Returns the earliest date of the section."""
 
-        return min((e.date for e in self.full_entries), default=None)
+        return self._date_bounds[0]
 
     def last_date(self):
         """Returns the latest date of the section."""
 
-        return max((e.date for e in self.full_entries), default=None)
+        return self._date_bounds[1]
+
+    def full_entries_between(self, start, end):
+        """Return a new list of the full entries dated from start included to
+        end excluded, in the same order as self.entries."""
+
+        # The date bounds avoid checking every entry when the section is
+        # entirely inside or outside the interval
+        first, last = self._date_bounds
+        if first is None or first >= end or last < start:
+            return []
+
+        if first >= start and last < end:
+            return list(self.full_entries)
+
+        # Chronological sections are sliced on the dates of the interval
+        dates = self._sorted_dates
+        if dates is not None:
+            lo = bisect.bisect_left(dates, start)
+            hi = bisect.bisect_left(dates, end)
+            return self.full_entries[lo:hi]
+
+        return [e for e in self.full_entries if start <= e.date < end]
+
+    def invalidate(self):
+        """Drop the values cached from the entries."""
+
+        self.__dict__.pop("full_entries", None)
+        self.__dict__.pop("title_comment", None)
+        self.__dict__.pop("title", None)
+        self.__dict__.pop("_sorted_dates", None)
+        self.__dict__.pop("_date_bounds", None)
+
+    def append(self, entry):
+        """Add an entry at the end of the section."""
+
+        self.entries.append(entry)
+        self.invalidate()
+
+    def remove(self, entry):
+        """Remove the first entry equal to the given one."""
+
+        self.entries.remove(entry)
+        self.invalidate()
 
     def sort(self):
         """Sort the entries by date, hours, rate.
 
         If the section contain comment entries, return UnsortableError.
         """
+        # With the cached full entries, counting is enough to find comments
         n = self._title_comment_count()
-        if not all(isinstance(e, EntryFull) for e in self.entries[n:]):
+        full_entries = self.full_entries
+        if len(full_entries) != len(self.entries) - n:
             raise UnsortableError("Can't sort sections with comments")
-        self.entries[n:] = sorted(self.entries[n:])
+
+        keys = list(map(operator.attrgetter("date", "hours", "rate"), full_entries))
+        # Entries are usually appended in order, don't reorder a sorted list
+        if all(k1 <= k2 for k1, k2 in itertools.pairwise(keys)):
+            return
+
+        self.entries[n:] = [e for _, e in sorted(zip(keys, full_entries), key=operator.itemgetter(0))]
+        self.invalidate()
 
     def __iter__(self):
         return iter(self.full_entries)
 
     def __str__(self):
-        return "\n".join(str(e) for e in self.entries)
+        return "\n".join(map(str, self.entries))
 
 
 
@@ -147,15 +221,29 @@ class Workfile:
 
     sections: list
 
+    def _bounds(self):
+        """Returns the earliest and latest dates of the workfile."""
+
+        first = last = None
+        for s in self.sections:
+            sec_first, sec_last = s.first_date(), s.last_date()
+            if sec_first is None:
+                continue
+            if first is None or sec_first < first:
+                first = sec_first
+            if last is None or sec_last > last:
+                last = sec_last
+        return first, last
+
     def first_date(self):
         """Returns the earliest date of the workfile."""
 
-        return min((e.date for s in self.sections for e in s.full_entries), default=None)
+        return self._bounds()[0]
 
     def last_date(self):
         """Returns the latest date of the workfile."""
 
-        return max((e.date for s in self.sections for e in s.full_entries), default=None)
+        return self._bounds()[1]
 
     def filter(self, start, end, titles=None):
         """Filter the workfile according to a date interval and an optional title.
@@ -166,40 +254,51 @@ class Workfile:
         return WorkfileFiltered(self, start, end, titles)
 
     @staticmethod
-    def _read_section(fp):
-        fp = more_itertools.peekable(fp)
+    def _parse_section(lines, dates=None, numbers=None):
+        """Build a Section from its non-empty lines.
 
-        entries = []
-        for line in fp:
-            if line.endswith("\n"):
-                line = line[:-1]
+        Dates and numbers repeat a lot in a workfile. dates and numbers are
+        dicts mapping the strings already parsed to their value, they can be
+        shared between the calls.
+        """
 
-            if line == "":
-                break
+        if dates is None:
+            dates = {}
+        if numbers is None:
+            numbers = {}
 
+        entries = []
+        for line in lines:
             if line.startswith("#"):
                 entries.append(EntryComment(line[1:]))
                 continue
 
             date, hours, rate, *linecomm = line.split(" ", maxsplit=3)
-            date = datetime.date.fromisoformat(date)
-            hours = decimal.Decimal(hours)
-            rate = decimal.Decimal(rate)
+            d = dates.get(date)
+            if d is None:
+                d = dates[date] = datetime.date.fromisoformat(date)
+            date = d
+
+            h = numbers.get(hours)
+            if h is None:
+                h = numbers[hours] = decimal.Decimal(hours)
+            hours = h
+
+            r = numbers.get(rate)
+            if r is None:
+                r = numbers[rate] = decimal.Decimal(rate)
+            rate = r
+
             if linecomm:
-                linecomm = linecomm[0]
-                assert "#" in linecomm
-                commidx = linecomm.index("#")
-                prespaces = linecomm.count(" ", 0, commidx) + 1
-                linecomm = linecomm[commidx + 1:]
+                spaces, sep, linecomm = linecomm[0].partition("#")
+                assert sep
+                prespaces = spaces.count(" ") + 1
             else:
                 prespaces = None
                 linecomm = None
 
             entries.append(EntryFull(date, hours, rate, linecomm, prespaces))
 
-        if not entries:
-            raise StopIteration
-
         return Section(entries)
 
     @classmethod
@@ -207,13 +306,16 @@ class Workfile:
         """Read a workfile and return an instance of Workfile."""
 
         wf = cls([])
+        dates = {}
+        numbers = {}
 
         with open(workfilename) as fp:
-            while True:
-                try:
-                    wf.sections.append(cls._read_section(fp))
-                except StopIteration:
-                    break
+            lines = fp.read().split("\n")
+
+        # Sections are separated by one or several empty lines
+        for blank, seclines in itertools.groupby(lines, key=lambda l: l == ""):
+            if not blank:
+                wf.sections.append(cls._parse_section(seclines, dates, numbers))
 
         return wf
 
@@ -224,7 +326,13 @@ class Workfile:
         return len(self.sections)
 
     def __str__(self):
-        return "\n\n".join(str(s) for s in self.sections)
+        # Join all the lines at once, sections are separated by an empty line
+        lines = []
+        for i, s in enumerate(self.sections):
+            if i != 0:
+                lines.append("")
+            lines.extend(map(str, s.entries))
+        return "\n".join(lines)
 
 
 
@@ -259,11 +367,7 @@ class SectionFiltered:
         """A view of the entries of the underlying section where only the full
         entries within the date interval are returned."""
 
-        ret = []
-        for e in self.section.full_entries:
-            if e.date < self.end_date and e.date >= self.start_date:
-                ret.append(e)
-        return ret
+        return self.section.full_entries_between(self.start_date, self.end_date)
 
     def filter(self, start, end):
         """Filter the workfile according to a date interval.
@@ -309,15 +413,15 @@ class WorkfileFiltered:
 
         ret = []
         for s in self.workfile.sections:
+            if self.titles is not None and s.title not in self.titles:
+                continue
+
             sec_first = s.first_date()
             sec_last = s.last_date()
 
             if sec_first is None or sec_last is None:
                 continue
 
-            if self.titles is not None and s.title not in self.titles:
-                continue
-
             if sec_first < self.end_date and sec_last >= self.start_date:
                 ret.append(SectionFiltered(s, self.start_date, self.end_date))
         return ret
@@ -4,16 +4,18 @@ import argparse
 import collections
 import dataclasses
 import datetime
+import functools
+import io
 import locale
 import logging
 import logging.config
+import operator
 import os
-import subprocess
-import shutil
 import sys
 
 import approxmatch
 import invoice
+import textdiff
 import workfile
 
 
@@ -162,7 +164,10 @@ def list_titles_dates(wf, titles=None, *, date_start=None, date_end=None):
             print(f"{s.first_date()} - {s.last_date()}: {s.title}")
         return
 
-    scores = {s.title: min(approxmatch.approx_score(t, s.title) for t in titles) for s in wff}
+    # Score all the section titles at once against each title
+    sectitles = [s.title for s in wff]
+    scores = [approxmatch.approx_scores(t, sectitles) for t in titles]
+    scores = dict(zip(sectitles, map(min, zip(*scores))))
     sections = sorted(wff, key=lambda s: scores[s.title])
     for sec in sections:
         s = sec.section
@@ -175,14 +180,15 @@ def find_section(wf, title, date_start=None, date_end=None):
     """Find the Workfile section with the given title. Returns a
     WorkfileFiltered."""
 
-    wff = wf.filter(date_start, date_end, [title])
+    # Filter by date once, the titles are then compared on the result
+    nearby = wf.filter(date_start, date_end).sections
+    secs = [s for s in nearby if s.title == title]
 
-    if len(wff) == 0:
+    if len(secs) == 0:
         logging.info("No section with exact title %r", title)
         logging.info("Switching to approximate matching")
 
-        wff = wf.filter(date_start, date_end)
-        titles = [s.title for s in wff]
+        titles = [s.title for s in nearby]
         logging.debug("List of section titles in near time: %r", titles)
         actual_title = approxmatch.approx_match(title, titles)
 
@@ -193,21 +199,21 @@ def find_section(wf, title, date_start=None, date_end=None):
 
         logging.info("Matched with: %s", actual_title)
         title = actual_title
-        wff = wf.filter(date_start, date_end, [title])
+        secs = [s for s in nearby if s.title == title]
 
     logging.debug("For title %r, found sections:", title)
-    for sec in wff:
+    for sec in secs:
         logging.debug("# %s", sec.title)
         for e in sec:
             logging.debug("    %s", e)
 
-    if len(wff) > 1:
+    if len(secs) > 1:
         logging.warning("%d sections with name %r have been found. Using the last one.",
-                        len(wff), title)
-        sec = wff[-1].section
-        wff = wf.filter(sec.first_date(), sec.last_date(), titles=[title])
+                        len(secs), title)
+        sec = secs[-1].section
+        return wf.filter(sec.first_date(), sec.last_date(), titles=[title])
 
-    return wff
+    return wf.filter(date_start, date_end, [title])
 
 
 
@@ -234,6 +240,29 @@ def find_sections(wf, titles=None, date_start=None, date_end=None):
 
 
 
+@functools.lru_cache
+def _compared_fields(cls, include_fields):
+    """Names of the fields of the dataclass cls compared by
+    partial_match_dataclass. include_fields is the tuple of its keyword
+    arguments items."""
+
+    include_fields = dict(include_fields)
+    fields = set()
+    for f in dataclasses.fields(cls):
+        if f.compare or include_fields.pop(f.name, False):
+            fields.add(f.name)
+
+    if not any(include_fields.values()):
+        fields -= include_fields.keys()
+    elif all(include_fields.values()):
+        fields &= include_fields.keys()
+    else:
+        raise NotImplementedError("Mixing True and False values not supported")
+
+    return tuple(sorted(fields))
+
+
+
 def partial_match_dataclass(ref, data, **include_fields):
     """Find the subset of `data' that are equal to `ref' when comparing only
     a subset of fields.
@@ -250,19 +279,13 @@ def partial_match_dataclass(ref, data, **include_fields):
     True and False keyword arguments is not allowed.
     """
 
-    fields = set()
-    for f in dataclasses.fields(ref):
-        if f.compare or include_fields.pop(f.name, False):
-            fields.add(f.name)
+    fields = _compared_fields(type(ref), tuple(sorted(include_fields.items())))
+    if not fields:
+        return list(data)
 
-    if not any(include_fields.values()):
-        fields -= include_fields.keys()
-    elif all(include_fields.values()):
-        fields &= include_fields.keys()
-    else:
-        raise NotImplementedError("Mixing True and False values not supported")
-
-    return [d for d in data if all(getattr(ref, f) == getattr(d, f) for f in fields)]
+    getter = operator.attrgetter(*fields)
+    refvalues = getter(ref)
+    return [d for d in data if getter(d) == refvalues]
 
 
 
@@ -272,7 +295,43 @@ def match_items(ref, items, **include_fields):
 
     assert "desc" not in include_fields, "Items are always matched with an approximate description"
     matches = partial_match_dataclass(ref, items, desc=False, **include_fields)
-    return [m for m in matches if approxmatch.approx_score(ref.desc, m.desc) / len(ref.desc) < 0.1]
+    # Same as score / len(ref.desc) < 0.1 without the division
+    desclen = len(ref.desc)
+    return [m for m in matches if approxmatch.approx_score(ref.desc, m.desc) * 10 < desclen]
+
+
+
+def index_items(items, **include_fields):
+    """Group the distinct items by the values of the fields compared by
+    match_items, apart from the description.
+
+    Return the function extracting these values from an item and the dict
+    mapping them to the list of items.
+    """
+
+    include_fields = tuple(sorted(dict(include_fields, desc=False).items()))
+    getter = operator.attrgetter(*_compared_fields(invoice.Item, include_fields))
+
+    buckets = collections.defaultdict(list)
+    for i in items:
+        buckets[getter(i)].append(i)
+
+    return getter, buckets
+
+
+
+def match_counted_items(ref, items, index, **include_fields):
+    """Match a Counter of items using function match_items.
+
+    index is the value returned by index_items for the same items and fields.
+    Only the items with the same field values as ref are compared, each of
+    them once. They are returned as many times as they are counted.
+    """
+
+    getter, buckets = index
+    candidates = [i for i in buckets.get(getter(ref), ()) if items[i] > 0]
+    matches = match_items(ref, candidates, **include_fields)
+    return [m for m in matches for _ in range(items[m])]
 
 
 
@@ -280,8 +339,9 @@ def _update_invoice_ignore_sum_match(added, removed):
     """If an item already match a sum of existing items, match them. Allow
     approximate description."""
 
+    index = index_items(removed, time=False)
     for a in added.elements():
-        matches = match_items(a, removed.elements(), time=False)
+        matches = match_counted_items(a, removed, index, time=False)
         total_time = sum(m.time for m in matches)
 
         if total_time == a.time:
@@ -299,8 +359,9 @@ def _update_invoice_fix_partial(added, removed, curitems):
     """If existing items match everything but are missing some time, either
     fix the item or add one. Allow approximate description."""
 
+    index = index_items(removed, time=False)
     for a in added.elements():
-        matches = match_items(a, removed.elements(), time=False)
+        matches = match_counted_items(a, removed, index, time=False)
         total_time = sum(m.time for m in matches)
 
         if len(matches) == 1:
@@ -341,12 +402,18 @@ def _update_invoice_fix_partial(added, removed, curitems):
 def update_invoice(inv, secs):
     """Update an Invoice object to have all the items related to the Workfile section."""
 
-    newitems = collections.Counter()
+    newitems = []
     for sec in secs:
-        for e in sec:
-            item = invoice.Item(sec.title, e.date, e.hours, "heures", e.rate, 0)
-            newitems[item] += 1
+        # All the items of a section share the same interned description
+        title = sec.title if sec.title is None else sys.intern(sec.title)
+        newitems.extend(invoice.Item(title, e.date, e.hours, "heures", e.rate, 0) for e in sec)
+
+    # Invoices written by this program have their items sorted
+    if sorted(newitems) == inv.items:
+        logging.debug("The invoice is already up to date")
+        return inv
 
+    newitems = collections.Counter(newitems)
     curitems = collections.Counter(inv.items)
 
     added = newitems - curitems
@@ -356,7 +423,11 @@ def update_invoice(inv, secs):
         logging.debug("Ignoring a match: %s", item)
 
     added, removed = _update_invoice_ignore_sum_match(added, removed)
-    added, removed = _update_invoice_fix_partial(added, removed, curitems)
+
+    # Partial matches need items left on both sides. The counts are only
+    # decremented, items that have been consumed are still in the Counters.
+    if added.total() > 0 and removed.total() > 0:
+        added, removed = _update_invoice_fix_partial(added, removed, curitems)
 
     if added or removed:
         inv.items = sorted((curitems - removed + added).elements())
@@ -379,16 +450,21 @@ def update_invoice_file(args, secs):
     inv = invoice.Invoice.fromfile(infile)
     update_invoice(inv, secs)
 
+    new_invoice = str(inv)
     new_invoice_file = invoice_file + ".new"
-    with open(new_invoice_file, "w") as fp:
-        fp.write(str(inv))
 
     if args.show_diff:
-        subprocess.call(["diff", "--color", "--new-file", "--text", "--unified",
-                         invoice_file, new_invoice_file])
+        # A missing invoice is shown as empty, like diff --new-file
+        try:
+            with open(invoice_file) as fp:
+                oldlines = fp.readlines()
+        except FileNotFoundError:
+            oldlines = []
+        textdiff.print_diff(oldlines, io.StringIO(new_invoice).readlines(), invoice_file, new_invoice_file)
 
-    if not args.write:
-        os.unlink(new_invoice_file)
+    if args.write:
+        with open(new_invoice_file, "w") as fp:
+            fp.write(new_invoice)
 
     if args.write and not args.force:
         res = input("Write these changes? [yN] ")
@@ -401,14 +477,14 @@ def update_invoice_file(args, secs):
         bak_invoice_file = invoice_file + ".bak"
         backed_up = False
         try:
-            shutil.move(invoice_file, bak_invoice_file)
+            os.replace(invoice_file, bak_invoice_file)
         except FileNotFoundError as e:
             if e.filename != invoice_file:
                 raise
         else:
             backed_up = True
 
-        shutil.move(new_invoice_file, invoice_file)
+        os.replace(new_invoice_file, invoice_file)
 
         if backed_up:
             logging.info("Writing changes to %s, old workfile copied to %s",
@@ -501,8 +577,9 @@ def main():
         date_end = next_month(date_start)
     else:
         # The default date interval is [now - 3 months, now + 1 month)
-        date_start = datetime.date.today() - datetime.timedelta(days=91)
-        date_end = datetime.date.today() + datetime.timedelta(days=30)
+        today = datetime.date.today()
+        date_start = today - datetime.timedelta(days=91)
+        date_end = today + datetime.timedelta(days=30)
 
     if args.list_sections:
         list_titles_dates(wf, args.section_title, date_start=date_start, date_end=date_end)